@@ -1,7 +1,21 @@
 # app/crud.py
 import logging
-from sqlalchemy.orm import Session
+import orjson
+from sqlalchemy import insert, or_, select, text, update
+from sqlalchemy.orm import Session, load_only
 from . import models  # Assuming models.py defines TrainingPair
+from .prompts import EXAMPLE_PROMPT_FORMAT_VERSION, format_example_block
+
+# In-process cache for get_training_examples.
+# Training pairs are only added through the create functions below, which bump
+# _write_epoch after committing; a cached result is valid while its epoch matches.
+_write_epoch = 0
+_examples_cache: tuple[int, int, list] | None = None  # (epoch, limit, examples)
+
+
+def _invalidate_examples_cache():
+    global _write_epoch
+    _write_epoch += 1
 
 
 def create_training_pair(
@@ -17,43 +31,176 @@ def create_training_pair(
         original_filename: Optional filename for reference.
 
     Returns:
-        The created TrainingPair object.
+        The ID of the created TrainingPair.
     """
     try:
-        db_pair = models.TrainingPair(
-            text_content=text_content,
-            json_data=json_data,  # SQLAlchemy handles dict -> JSON
-            original_filename=original_filename,
+        # Take the write lock up front so the transaction never has to upgrade
+        # from a read lock (which can deadlock against another writer).
+        db.execute(text("BEGIN IMMEDIATE"))
+        # Core INSERT ... RETURNING skips the ORM unit-of-work machinery, since the
+        # endpoint never uses the instance again.
+        stmt = (
+            insert(models.TrainingPair)
+            .values(
+                text_content=text_content,
+                json_data=orjson.dumps(json_data),
+                original_filename=original_filename,
+                example_prompt_block=format_example_block(text_content, json_data),
+                example_prompt_version=EXAMPLE_PROMPT_FORMAT_VERSION,
+            )
+            .returning(models.TrainingPair.id)
         )
-        db.add(db_pair)
+        pair_id = db.execute(stmt).scalar_one()
         db.commit()
-        db.refresh(db_pair)
-        logging.info(f"Successfully created training pair with ID: {db_pair.id}")
-        return db_pair
+        _invalidate_examples_cache()
+        logging.info(f"Successfully created training pair with ID: {pair_id}")
+        return pair_id
     except Exception as e:
         db.rollback()  # Rollback in case of error
         logging.error(f"Error creating training pair in DB: {e}")
         raise  # Re-raise the exception to be handled by the caller
 
 
+def create_training_pairs_bulk(db: Session, rows: list[dict]):
+    """
+    Saves many TrainingPair records in a single INSERT and a single commit.
+
+    Args:
+        db: The database session.
+        rows: A list of dicts with the keys 'text_content', 'json_data' and
+            optionally 'original_filename'.
+
+    Returns:
+        The number of rows inserted.
+    """
+    if not rows:
+        return 0
+    rows = [
+        {
+            **row,
+            "json_data": orjson.dumps(row["json_data"]),
+            "example_prompt_block": format_example_block(
+                row["text_content"], row["json_data"]
+            ),
+            "example_prompt_version": EXAMPLE_PROMPT_FORMAT_VERSION,
+        }
+        for row in rows
+    ]
+    try:
+        db.execute(text("BEGIN IMMEDIATE"))
+        db.execute(insert(models.TrainingPair), rows)
+        db.commit()
+        _invalidate_examples_cache()
+        logging.info(f"Successfully created {len(rows)} training pairs in bulk.")
+        return len(rows)
+    except Exception as e:
+        db.rollback()
+        logging.error(f"Error bulk creating training pairs in DB: {e}")
+        raise
+
+
+def refresh_example_prompt_blocks(db: Session, batch_size: int = 200):
+    """
+    Re-renders example_prompt_block for rows that have no block yet or were
+    rendered with an older EXAMPLE_PROMPT_FORMAT_VERSION.
+    Rows are processed in batches by ascending ID, each in its own write
+    transaction, so the table is never loaded into memory at once.
+
+    Args:
+        db: The database session (must be able to write).
+        batch_size: The number of rows re-rendered per transaction.
+
+    Returns:
+        The number of rows updated.
+    """
+    pair = models.TrainingPair
+    is_stale = or_(
+        pair.example_prompt_version.is_(None),
+        pair.example_prompt_version != EXAMPLE_PROMPT_FORMAT_VERSION,
+    )
+    updated = 0
+    last_id = 0
+    try:
+        while True:
+            # Take the write lock before reading the batch, as create_training_pair does
+            db.execute(text("BEGIN IMMEDIATE"))
+            rows = db.execute(
+                select(pair.id, pair.text_content, pair.json_data)
+                .where(is_stale, pair.id > last_id)
+                .order_by(pair.id)
+                .limit(batch_size)
+            ).all()
+            if not rows:
+                db.rollback()
+                break
+            db.execute(
+                update(pair),
+                [
+                    {
+                        "id": row.id,
+                        # orjson reads both the BLOB encoding and legacy JSON text
+                        "example_prompt_block": format_example_block(
+                            row.text_content, orjson.loads(row.json_data)
+                        ),
+                        "example_prompt_version": EXAMPLE_PROMPT_FORMAT_VERSION,
+                    }
+                    for row in rows
+                ],
+            )
+            db.commit()
+            updated += len(rows)
+            last_id = rows[-1].id
+        if updated:
+            _invalidate_examples_cache()
+            logging.info(f"Re-rendered example prompt blocks for {updated} training pairs.")
+        return updated
+    except Exception as e:
+        db.rollback()
+        if updated:
+            _invalidate_examples_cache()
+        logging.error(f"Error refreshing example prompt blocks: {e}")
+        raise
+
+
 def get_training_examples(db: Session, limit: int = 5):
     """
     Retrieves a specified number of recent training examples from the database.
+    Results are cached in-process until the next training pair is written.
 
     Args:
-        db: The database session.
+        db: A read session. Its transaction is ended before returning.
         limit: The maximum number of examples to retrieve.
 
     Returns:
-        A list of TrainingPair objects.
+        A list of TrainingPair objects (detached from the session).
     """
+    global _examples_cache
+    cache = _examples_cache
+    if cache is not None and cache[0] == _write_epoch and cache[1] == limit:
+        return list(cache[2])
+
     try:
+        epoch = _write_epoch
         examples = (
             db.query(models.TrainingPair)
-            .order_by(models.TrainingPair.id.desc())
+            # Only load the pre-rendered prompt block the prompt builder uses
+            .options(
+                load_only(
+                    models.TrainingPair.id,
+                    models.TrainingPair.example_prompt_block,
+                )
+            )
+            # id breaks ties between rows created within the same second
+            .order_by(
+                models.TrainingPair.created_at.desc(), models.TrainingPair.id.desc()
+            )
             .limit(limit)
             .all()
         )
+        # Detach the rows so they stay usable after this session is closed
+        for example in examples:
+            db.expunge(example)
+        _examples_cache = (epoch, limit, examples)
         logging.info(
             f"Retrieved {len(examples)} training examples from DB (limit: {limit})."
         )
@@ -61,6 +208,10 @@ def get_training_examples(db: Session, limit: int = 5):
     except Exception as e:
         logging.error(f"Error retrieving training examples from DB: {e}")
         return []  # Return empty list on error
+    finally:
+        # End the read transaction so its pooled connection is returned now,
+        # not when the request (possibly a long streaming response) finishes.
+        db.rollback()
 
 
 def get_all_training_pairs(db: Session):
@@ -1,12 +1,13 @@
 # app/database.py
 import os
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 import logging
 
 # Define the path for the SQLite database file within the container
-DATABASE_DIR = "/app/data"  # Using a subdirectory within /app
+# Override with DB_DIR, e.g. DB_DIR=/dev/shm/app to keep a throwaway training set in RAM
+DATABASE_DIR = os.getenv("DB_DIR", "/app/data")  # Using a subdirectory within /app
 SQLALCHEMY_DATABASE_URL = f"sqlite:///{DATABASE_DIR}/sqlitedb.db"
 
 # Create the directory if it doesn't exist
@@ -15,26 +16,85 @@ logging.info(f"Database directory: {DATABASE_DIR}")
 logging.info(f"Database URL: {SQLALCHEMY_DATABASE_URL}")
 
 
-# Create the SQLAlchemy engine
+# PRAGMAs applied to every new SQLite connection.
+# WAL lets readers proceed while a write is in progress, and synchronous=NORMAL
+# only fsyncs at checkpoints instead of on every commit (safe under WAL).
+SQLITE_PRAGMAS = (
+    "journal_mode=WAL",
+    "busy_timeout=5000",  # Wait up to 5s on a locked database instead of failing
+    "synchronous=NORMAL",
+    "cache_size=-20000",  # Negative value = size in KiB (~20 MB page cache)
+    "temp_store=MEMORY",
+    "foreign_keys=ON",
+    "mmap_size=268435456",  # Read pages via a 256 MB memory map instead of read() calls
+)
+
+# SQLite only ever allows one writer at a time, so writes go through a dedicated
+# single-connection pool while reads get their own pool sized to the CPU count.
+READ_POOL_SIZE = os.cpu_count() or 1
+
+# Create the SQLAlchemy engines
 # connect_args is needed for SQLite to handle multi-threading correctly with FastAPI
 engine = create_engine(
-    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
+    SQLALCHEMY_DATABASE_URL,
+    connect_args={"check_same_thread": False},
+    pool_size=1,
+    max_overflow=0,
+)
+read_engine = create_engine(
+    SQLALCHEMY_DATABASE_URL,
+    connect_args={"check_same_thread": False},
+    pool_size=READ_POOL_SIZE,
+    max_overflow=0,
 )
 
-# Create a SessionLocal class - instances of this class will be actual database sessions
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+def _apply_pragmas(dbapi_conn, pragmas):
+    cursor = dbapi_conn.cursor()
+    for pragma in pragmas:
+        cursor.execute(f"PRAGMA {pragma}")
+    cursor.close()
+
+
+@event.listens_for(engine, "connect")
+def _set_sqlite_pragma(dbapi_conn, _):
+    """Applies the SQLite PRAGMA tuning whenever a new write connection is opened."""
+    _apply_pragmas(dbapi_conn, SQLITE_PRAGMAS)
+
+
+@event.listens_for(read_engine, "connect")
+def _set_sqlite_read_pragma(dbapi_conn, _):
+    """Same tuning as the write engine, plus query_only so readers can never write."""
+    _apply_pragmas(dbapi_conn, SQLITE_PRAGMAS + ("query_only=ON",))
+
+
+# Session factories - instances of these classes will be actual database sessions
+WriteSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+ReadSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=read_engine)
 
 # Create a Base class - our ORM models will inherit from this class
 Base = declarative_base()
 
 
-# Dependency to get DB session
-def get_db():
+# Dependencies to get DB sessions
+def get_write_db():
+    """
+    Dependency function that provides a write session (single-writer pool) per request.
+    Ensures the session is always closed after the request.
+    """
+    db = WriteSessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+def get_read_db():
     """
-    Dependency function that provides a database session per request.
+    Dependency function that provides a read-only session per request.
     Ensures the session is always closed after the request.
     """
-    db = SessionLocal()
+    db = ReadSessionLocal()
     try:
         yield db
     finally:
@@ -51,6 +111,44 @@ def init_db():
         # This creates tables based on models imported elsewhere that inherit from Base
         Base.metadata.create_all(bind=engine)
         logging.info("Database tables created successfully (if they didn't exist).")
+        migrate_db()
     except Exception as e:
         logging.error(f"Error creating database tables: {e}")
         raise
+
+
+# Columns added to training_pairs after the initial schema, with the statements
+# that bring an existing table up to date. create_all() only creates missing
+# tables, so databases created by older versions need these applied.
+TRAINING_PAIRS_MIGRATIONS = {
+    "created_at": [
+        "ALTER TABLE training_pairs ADD COLUMN created_at DATETIME",
+        # SQLite can't add a column with a non-constant default, so backfill it
+        "UPDATE training_pairs SET created_at = CURRENT_TIMESTAMP",
+        "CREATE INDEX IF NOT EXISTS ix_training_pairs_created_at ON training_pairs (created_at)",
+    ],
+    # Filled from Python by crud.refresh_example_prompt_blocks
+    "example_prompt_block": [
+        "ALTER TABLE training_pairs ADD COLUMN example_prompt_block TEXT",
+    ],
+    "example_prompt_version": [
+        "ALTER TABLE training_pairs ADD COLUMN example_prompt_version INTEGER",
+    ],
+}
+
+
+def migrate_db():
+    """
+    Adds any columns missing from an existing training_pairs table.
+    Safe to call on every startup; does nothing once the schema is current.
+    """
+    with engine.begin() as conn:
+        existing = {
+            row[1] for row in conn.execute(text("PRAGMA table_info(training_pairs)"))
+        }
+        for column, statements in TRAINING_PAIRS_MIGRATIONS.items():
+            if column in existing:
+                continue
+            logging.info(f"Migrating database: adding training_pairs.{column}")
+            for statement in statements:
+                conn.execute(text(statement))
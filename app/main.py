@@ -1,9 +1,18 @@
 # app/main.py
+import asyncio
 import logging
 import os
+import warnings
 import json
+from typing import List
 from fastapi import FastAPI, File, UploadFile, Request, Depends, HTTPException, Form
-from fastapi.responses import HTMLResponse, JSONResponse, RedirectResponse
+from fastapi.responses import (
+    HTMLResponse,
+    ORJSONResponse,
+    RedirectResponse,
+    StreamingResponse,
+)
+from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.templating import Jinja2Templates
 from fastapi.staticfiles import StaticFiles
 from sqlalchemy.orm import Session
@@ -11,10 +20,12 @@ from sqlalchemy.orm import Session
 # Import database functions, models, crud, and utility functions
 from . import models, utils, crud
 from .database import (
-    SessionLocal,
+    WriteSessionLocal,
     engine,
     init_db,
-    get_db,
+    migrate_db,
+    get_read_db,
+    get_write_db,
 )  # Ensure init_db is called if needed
 
 # --- Logging Setup ---
@@ -23,7 +34,41 @@ logging.basicConfig(
 )
 
 # --- FastAPI App Initialization ---
-app = FastAPI(title="PDF/DOCX JSON Training and Query API with Gemini")
+# FastAPI >= 0.131 deprecates ORJSONResponse in favour of Pydantic serialization,
+# which needs declared return types; these endpoints return plain dicts, so keep
+# orjson and silence just that warning.
+warnings.filterwarnings("ignore", message="ORJSONResponse is deprecated")
+app = FastAPI(
+    title="PDF/DOCX JSON Training and Query API with Gemini",
+    default_response_class=ORJSONResponse,
+)
+# Compress larger responses (e.g. generated JSON) for clients that accept gzip
+app.add_middleware(GZipMiddleware, minimum_size=1024)
+
+# --- Request Size Limit ---
+# Allowance for multipart boundaries/headers and the small JSON file that
+# accompanies a training document.
+FORM_OVERHEAD = 1024 * 1024
+# Upper bound on a whole request body, by path. Individual files are also limited
+# to utils.MAX_UPLOAD_SIZE; these caps stop oversized bodies before they are received.
+MAX_REQUEST_SIZES = {
+    "/upload_training_data_batch": 4 * utils.MAX_UPLOAD_SIZE,
+}
+DEFAULT_MAX_REQUEST_SIZE = utils.MAX_UPLOAD_SIZE + FORM_OVERHEAD
+
+
+@app.middleware("http")
+async def limit_request_size(request: Request, call_next):
+    """Rejects oversized requests from their Content-Length before the body is read."""
+    max_size = MAX_REQUEST_SIZES.get(request.url.path, DEFAULT_MAX_REQUEST_SIZE)
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > max_size:
+        logging.warning(
+            f"Rejected request to {request.url.path}: Content-Length {content_length} exceeds {max_size}"
+        )
+        return ORJSONResponse(status_code=413, content={"detail": "Request too large."})
+    return await call_next(request)
+
 
 # --- Database Initialization ---
 # Ensure tables are created (idempotent operation)
@@ -31,6 +76,9 @@ try:
     # init_db() # Call the function to create tables
     # Alternatively, rely on the import side effect if database.py runs create_all
     models.Base.metadata.create_all(bind=engine)
+    migrate_db()  # Bring tables created by older versions up to date
+    with WriteSessionLocal() as db:
+        crud.refresh_example_prompt_blocks(db)
     logging.info("Database tables checked/created successfully on startup.")
 except Exception as e:
     logging.error(f"CRITICAL: Failed to initialize database on startup: {e}")
@@ -82,7 +130,7 @@ async def upload_training_data(
     request: Request,
     doc_file: UploadFile = File(..., description="Document file (PDF or DOCX)"),
     json_file: UploadFile = File(..., description="Corresponding JSON data file"),
-    db: Session = Depends(get_db),
+    db: Session = Depends(get_write_db),
 ):
     """
     Handles the upload of a document (PDF/DOCX) and its corresponding JSON file.
@@ -91,6 +139,9 @@ async def upload_training_data(
     logging.info(
         f"Received training upload request. Document: {doc_file.filename}, JSON: {json_file.filename}"
     )
+    # Reject oversized uploads before doing any work on them
+    utils.check_upload_size(doc_file)
+    utils.check_upload_size(json_file)
 
     # 1. Extract text from the document
     try:
@@ -138,7 +189,7 @@ async def upload_training_data(
         )
         logging.info(f"Successfully stored training pair for: {doc_file.filename}")
         # Use status_code=201 Created
-        return JSONResponse(
+        return ORJSONResponse(
             status_code=201,
             content={
                 "message": f"Training data from '{doc_file.filename}' and '{json_file.filename}' uploaded and stored successfully."
@@ -154,23 +205,121 @@ async def upload_training_data(
         )
 
 
+@app.post(
+    "/upload_training_data_batch",
+    summary="Upload Multiple Document/JSON Pairs for Training",
+    status_code=201,
+)
+async def upload_training_data_batch(
+    request: Request,
+    doc_files: List[UploadFile] = File(..., description="Document files (PDF or DOCX)"),
+    json_files: List[UploadFile] = File(
+        ..., description="Corresponding JSON data files, in the same order"
+    ),
+    db: Session = Depends(get_write_db),
+):
+    """
+    Handles the upload of several document/JSON pairs at once.
+    Documents and JSON files are paired by position. All pairs are stored with a
+    single bulk insert and one commit.
+    """
+    logging.info(
+        f"Received batch training upload request with {len(doc_files)} documents and {len(json_files)} JSON files."
+    )
+    if len(doc_files) != len(json_files):
+        raise HTTPException(
+            status_code=400,
+            detail="The number of document files must match the number of JSON files.",
+        )
+    # Validate every file before starting any parser threads
+    for doc_file in doc_files:
+        utils.check_document_type(doc_file)
+    for json_file in json_files:
+        utils.check_json_type(json_file)
+    for upload in [*doc_files, *json_files]:
+        utils.check_upload_size(upload)
+
+    # 1. Extract text and parse JSON for all files concurrently
+    try:
+        # return_exceptions=True lets every task finish before an error is raised,
+        # so no parse is left running after the request ends
+        results = await asyncio.gather(
+            *[utils.extract_text_from_upload(f) for f in doc_files],
+            *[utils.parse_json_upload(f) for f in json_files],
+            return_exceptions=True,
+        )
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+        extracted_texts = results[: len(doc_files)]
+        json_datas = results[len(doc_files) :]
+    except HTTPException as e:
+        logging.error(f"HTTPException during batch processing: {e.detail}")
+        raise e
+    except Exception as e:
+        logging.error(f"Unexpected error processing batch upload: {e}")
+        raise HTTPException(
+            status_code=500, detail=f"Server error processing batch upload: {str(e)}"
+        )
+
+    rows = [
+        {
+            "text_content": text,
+            "json_data": json_data,
+            "original_filename": doc_file.filename,
+        }
+        for doc_file, text, json_data in zip(doc_files, extracted_texts, json_datas)
+    ]
+
+    # 2. Store all pairs in the database
+    try:
+        count = crud.create_training_pairs_bulk(db=db, rows=rows)
+        return ORJSONResponse(
+            status_code=201,
+            content={"message": f"{count} training pairs uploaded and stored successfully."},
+        )
+    except Exception as e:
+        logging.error(f"Database error storing batch of training pairs: {e}")
+        raise HTTPException(
+            status_code=500, detail="Failed to store training data in database."
+        )
+
+
 @app.post("/process_query", summary="Process Query Document and Generate JSON")
 async def process_query(
     request: Request,
     doc_file: UploadFile = File(
         ..., description="Document file (PDF or DOCX) to query"
     ),
-    db: Session = Depends(get_db),
+    db: Session = Depends(get_read_db),
 ):
     """
     Handles the upload of a query document, extracts text, retrieves examples,
     calls the Gemini API to generate JSON, and returns the result.
     """
     logging.info(f"Received query request for document: {doc_file.filename}")
+    # Validate before starting any concurrent work, so a rejected request never
+    # leaves a worker thread using the request's DB session
+    utils.check_document_type(doc_file)
+    utils.check_upload_size(doc_file)
 
-    # 1. Extract text from the uploaded query document
+    # 1. Extract text from the query document and retrieve training examples
+    # concurrently; the DB read runs in a worker thread while the document parses.
+    # get_training_examples returns an empty list on DB errors, so a failed lookup
+    # just means generating without examples.
     try:
-        input_text = await utils.extract_text_from_upload(doc_file)
+        # return_exceptions=True waits for both tasks even if one fails, so the
+        # worker thread is done with the session before the request can end
+        results = await asyncio.gather(
+            utils.extract_text_from_upload(doc_file),
+            # Retrieve a limited number of recent examples (e.g., 5)
+            asyncio.to_thread(crud.get_training_examples, db, 5),
+            return_exceptions=True,
+        )
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+        input_text, examples = results
         if not input_text and input_text != "":
             logging.warning(f"Query document {doc_file.filename} yielded no text.")
             # Return an error or specific response if no text is found
@@ -187,41 +336,25 @@ async def process_query(
         raise HTTPException(
             status_code=500, detail="Server error processing query document."
         )
+    logging.info(f"Retrieved {len(examples)} examples for the prompt.")
 
-    # 2. Retrieve training examples from the database
-    try:
-        # Retrieve a limited number of recent examples (e.g., 5)
-        examples = crud.get_training_examples(db=db, limit=5)
-        logging.info(f"Retrieved {len(examples)} examples for the prompt.")
-    except Exception as e:
-        logging.error(f"Failed to retrieve training examples from database: {e}")
-        # Proceed without examples, or return an error depending on requirements
-        examples = []
-        # raise HTTPException(status_code=500, detail="Failed to retrieve training examples.") # Option to fail hard
-
-    # 3. Call the Gemini API utility function
+    # 2. Stream the Gemini API output back to the client
+    stream = utils.stream_json_with_gemini(
+        input_text=input_text,
+        examples=examples,
+        # Optionally pass model_name if you want to configure it per request
+    )
+    # Pull the first chunk before responding so that failures to start generation
+    # are still reported with a proper error status instead of a truncated body.
     try:
-        logging.info("Calling Gemini API utility function...")
-        generated_json_result = await utils.generate_json_with_gemini(
-            input_text=input_text,
-            examples=examples,
-            # Optionally pass model_name if you want to configure it per request
-        )
-
-        # Check if the result contains an error message from the utility function
-        if isinstance(generated_json_result, dict) and "error" in generated_json_result:
-            logging.error(f"Gemini generation failed: {generated_json_result['error']}")
-            # Return a 500 error or a more specific error code if applicable
-            raise HTTPException(status_code=500, detail=generated_json_result["error"])
-
-        logging.info(
-            f"Successfully received generated JSON for query: {doc_file.filename}"
-        )
-        # Return the successfully generated JSON
-        return JSONResponse(content=generated_json_result)
-
+        logging.info("Calling Gemini API streaming utility function...")
+        first_chunk = await anext(stream, "")
+        if not first_chunk:
+            raise HTTPException(
+                status_code=500, detail="The AI service returned an empty response."
+            )
     except HTTPException as e:
-        # Handle HTTPExceptions raised by generate_json_with_gemini or earlier steps
+        logging.error(f"Gemini generation failed: {e.detail}")
         raise e
     except Exception as e:
         logging.error(
@@ -232,6 +365,14 @@ async def process_query(
             detail=f"An unexpected server error occurred during JSON generation: {str(e)}",
         )
 
+    async def body():
+        yield first_chunk
+        async for chunk in stream:
+            yield chunk
+        logging.info(f"Finished streaming generated JSON for query: {doc_file.filename}")
+
+    return StreamingResponse(body(), media_type="application/json")
+
 
 # --- Root endpoint for basic check ---
 @app.get("/health", summary="Health Check")
@@ -1,5 +1,6 @@
 # app/models.py
-from sqlalchemy import Column, Integer, String, Text, JSON
+import orjson
+from sqlalchemy import Column, DateTime, Integer, LargeBinary, String, Text, func
 from .database import Base  # Import Base from the database module
 
 
@@ -14,8 +15,22 @@ class TrainingPair(Base):
     id = Column(Integer, primary_key=True, index=True)
     # Store the extracted text content from the document
     text_content = Column(Text, nullable=False)
-    # Store the corresponding JSON data as a JSON type (SQLite handles this)
-    # Ensure the JSON data is stored as a string if the DB doesn't natively support JSON
-    json_data = Column(JSON, nullable=False)
+    # Store the corresponding JSON data as orjson-encoded bytes (use json_dict to read it)
+    json_data = Column(LargeBinary, nullable=False)
     # Optional: Store the original filename for reference
     original_filename = Column(String, nullable=True)
+    # Insert time, indexed for "most recent examples" queries.
+    # default= also covers tables migrated in place, which have no server default.
+    created_at = Column(
+        DateTime, server_default=func.now(), default=func.now(), index=True
+    )
+    # Few-shot prompt section for this pair, pre-rendered at insert time
+    example_prompt_block = Column(Text, nullable=True)
+    # prompts.EXAMPLE_PROMPT_FORMAT_VERSION the block was rendered with
+    example_prompt_version = Column(Integer, nullable=True)
+
+    @property
+    def json_dict(self):
+        """The JSON data decoded to Python objects."""
+        # Rows written before json_data became a BLOB hold JSON text; orjson reads both
+        return orjson.loads(self.json_data)
@@ -0,0 +1,34 @@
+# app/prompts.py
+import orjson
+
+# Character budgets for text inlined into the Gemini prompt
+MAX_EXAMPLE_CHARS = 4000
+MAX_INPUT_CHARS = 30000
+TRUNCATION_MARKER = "\n…[truncated]"
+
+# Version of the format produced by format_example_block. Bump it whenever the
+# template or MAX_EXAMPLE_CHARS changes so stored blocks get re-rendered on startup.
+EXAMPLE_PROMPT_FORMAT_VERSION = 1
+
+
+def truncate_text(text: str, max_chars: int) -> str:
+    """Cuts text down to max_chars, marking the cut so the model knows it is partial."""
+    if len(text) <= max_chars:
+        return text
+    return text[:max_chars] + TRUNCATION_MARKER
+
+
+def format_example_block(text_content: str, json_data) -> str:
+    """
+    Formats one training pair as its few-shot prompt section (input text + output JSON).
+    Computed once when the pair is stored, so queries only have to join ready strings.
+    """
+    json_example_str = orjson.dumps(json_data, option=orjson.OPT_INDENT_2).decode()
+    return "\n".join(
+        [
+            "Input Text:",
+            f"```\n{truncate_text(text_content, MAX_EXAMPLE_CHARS)}\n```",
+            "Output JSON:",
+            f"```json\n{json_example_str}\n```",
+        ]
+    )
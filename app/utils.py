@@ -1,19 +1,28 @@
 # app/utils.py
-import io
+import asyncio
 import logging
 import os
-import json
-from PyPDF2 import PdfReader
+import orjson
+import tempfile
+import threading
+from typing import AsyncIterator, BinaryIO
+import pypdfium2 as pdfium
 from docx import Document
 from fastapi import UploadFile, HTTPException
 import google.generativeai as genai
 from google.generativeai.types import GenerationConfig, SafetySetting, HarmCategory
+from .prompts import MAX_INPUT_CHARS, truncate_text
 
 # --- Constants ---
 SUPPORTED_DOC_TYPES = [
     "application/pdf",
     "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
 ]
+# Largest single uploaded file accepted, in bytes
+MAX_UPLOAD_SIZE = 50 * 1024 * 1024
+# Uploads are spooled to disk once they exceed this size, capping per-request memory
+UPLOAD_SPOOL_MAX_SIZE = 8 * 1024 * 1024
+UPLOAD_READ_CHUNK_SIZE = 1024 * 1024
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 if not GEMINI_API_KEY:
     logging.warning(
@@ -25,18 +34,68 @@ else:
     genai.configure(api_key=GEMINI_API_KEY)
 
 
+def check_upload_size(file: UploadFile):
+    """Rejects an upload with 413 if its size is known and over MAX_UPLOAD_SIZE."""
+    if file.size and file.size > MAX_UPLOAD_SIZE:
+        logging.warning(
+            f"Upload too large: {file.filename} ({file.size} bytes, limit {MAX_UPLOAD_SIZE})"
+        )
+        raise HTTPException(
+            status_code=413,
+            detail=f"File too large: {file.filename}. Maximum size is {MAX_UPLOAD_SIZE // (1024 * 1024)} MB.",
+        )
+
+
+def check_document_type(file: UploadFile):
+    """Rejects an upload with 400 unless it is a PDF or DOCX document."""
+    if file.content_type not in SUPPORTED_DOC_TYPES:
+        logging.warning(
+            f"Unsupported file type uploaded: {file.content_type}. Filename: {file.filename}"
+        )
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unsupported file type: {file.content_type}. Please upload PDF or DOCX.",
+        )
+
+
+def check_json_type(file: UploadFile):
+    """Rejects an upload with 400 unless it is a JSON file."""
+    if file.content_type != "application/json":
+        logging.warning(
+            f"Incorrect content type for JSON upload: {file.content_type}. Filename: {file.filename}"
+        )
+        raise HTTPException(
+            status_code=400,
+            detail="JSON file must have content type 'application/json'",
+        )
+
+
 # --- Text Extraction Functions ---
 
+# PDFium is not thread-safe, and extraction runs in worker threads, so all
+# calls into it are serialized with this lock.
+_PDFIUM_LOCK = threading.Lock()
+
 
-def extract_text_from_pdf(file_stream: io.BytesIO) -> str:
+def extract_text_from_pdf(file_stream: BinaryIO) -> str:
     """Extracts text content from a PDF file stream."""
     try:
-        reader = PdfReader(file_stream)
-        text = ""
-        for page in reader.pages:
-            page_text = page.extract_text()
-            if page_text:
-                text += page_text + "\n"  # Add newline between pages
+        # PDFium is a native library, so parsing is much faster than pure-Python
+        # readers and releases the GIL while it works.
+        parts = []
+        with _PDFIUM_LOCK:
+            pdf = pdfium.PdfDocument(file_stream)
+            try:
+                for page in pdf:
+                    textpage = page.get_textpage()
+                    page_text = textpage.get_text_range()
+                    textpage.close()
+                    page.close()
+                    if page_text:
+                        parts.append(page_text)
+            finally:
+                pdf.close()
+        text = "\n".join(parts)  # Add newline between pages
         logging.info(f"Successfully extracted text from PDF. Length: {len(text)}")
         return text.strip()
     except Exception as e:
@@ -44,13 +103,11 @@ def extract_text_from_pdf(file_stream: io.BytesIO) -> str:
         return ""  # Return empty string on failure
 
 
-def extract_text_from_docx(file_stream: io.BytesIO) -> str:
+def extract_text_from_docx(file_stream: BinaryIO) -> str:
     """Extracts text content from a DOCX file stream."""
     try:
         document = Document(file_stream)
-        text = ""
-        for para in document.paragraphs:
-            text += para.text + "\n"
+        text = "\n".join(para.text for para in document.paragraphs)
         logging.info(f"Successfully extracted text from DOCX. Length: {len(text)}")
         return text.strip()
     except Exception as e:
@@ -60,34 +117,27 @@ def extract_text_from_docx(file_stream: io.BytesIO) -> str:
 
 async def extract_text_from_upload(file: UploadFile) -> str:
     """Extracts text from an uploaded file (PDF or DOCX)."""
-    if file.content_type not in SUPPORTED_DOC_TYPES:
-        logging.warning(
-            f"Unsupported file type uploaded: {file.content_type}. Filename: {file.filename}"
-        )
-        raise HTTPException(
-            status_code=400,
-            detail=f"Unsupported file type: {file.content_type}. Please upload PDF or DOCX.",
-        )
+    check_document_type(file)
 
     try:
-        content = await file.read()
-        file_stream = io.BytesIO(content)
-        # It's good practice to reset file pointer if the stream might be read again,
-        # though for BytesIO it might not be strictly necessary here.
-        file_stream.seek(0)
-
-        text = ""
-        if file.content_type == "application/pdf":
-            logging.info(f"Processing uploaded PDF: {file.filename}")
-            text = extract_text_from_pdf(file_stream)
-        elif (
-            file.content_type
-            == "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
-        ):
-            logging.info(f"Processing uploaded DOCX: {file.filename}")
-            text = extract_text_from_docx(file_stream)
-
-        file_stream.close()  # Close the stream
+        # Copy the upload in chunks into a spooled file instead of reading it all
+        # into memory; large uploads roll over to a temporary file on disk.
+        with tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_MAX_SIZE) as file_stream:
+            while chunk := await file.read(UPLOAD_READ_CHUNK_SIZE):
+                file_stream.write(chunk)
+            file_stream.seek(0)
+
+            text = ""
+            if file.content_type == "application/pdf":
+                logging.info(f"Processing uploaded PDF: {file.filename}")
+                # Parsing is blocking CPU work; run it off the event loop
+                text = await asyncio.to_thread(extract_text_from_pdf, file_stream)
+            elif (
+                file.content_type
+                == "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+            ):
+                logging.info(f"Processing uploaded DOCX: {file.filename}")
+                text = await asyncio.to_thread(extract_text_from_docx, file_stream)
 
         if not text:
             logging.warning(
@@ -108,21 +158,14 @@ async def extract_text_from_upload(file: UploadFile) -> str:
 
 async def parse_json_upload(file: UploadFile) -> dict:
     """Parses an uploaded JSON file."""
-    if file.content_type != "application/json":
-        logging.warning(
-            f"Incorrect content type for JSON upload: {file.content_type}. Filename: {file.filename}"
-        )
-        raise HTTPException(
-            status_code=400,
-            detail="JSON file must have content type 'application/json'",
-        )
+    check_json_type(file)
 
     try:
         content = await file.read()
-        json_data = json.loads(content)
+        json_data = orjson.loads(content)
         logging.info(f"Successfully parsed uploaded JSON file: {file.filename}")
         return json_data
-    except json.JSONDecodeError:
+    except orjson.JSONDecodeError:
         logging.error(f"Invalid JSON file uploaded: {file.filename}")
         raise HTTPException(status_code=400, detail="Invalid JSON file format")
     except Exception as e:
@@ -135,140 +178,208 @@ async def parse_json_upload(file: UploadFile) -> dict:
 
 # --- Gemini API Interaction ---
 
+def _render_examples_block(examples: list) -> str:
+    """Joins the stored prompt blocks of the given examples into the prompt's examples section."""
+    return "\n".join(
+        f"\nExample {i+1}:\n{example.example_prompt_block}"
+        for i, example in enumerate(examples)
+    )
+
+
+def _build_prompt(input_text: str, examples: list) -> str:
+    """Builds the few-shot prompt sent to Gemini."""
+    prompt_parts = [
+        "You are an assistant that analyzes text documents and generates structured JSON output based on the content.",
+        "Follow the format of the examples provided.",
+        "Given the following text input, generate the corresponding JSON object.",
+        "Output ONLY the JSON object itself, without any introductory text, explanation, or markdown formatting like ```json.",
+        "\n--- Examples ---",
+    ]
+
+    if not examples:
+        prompt_parts.append(
+            "\nNo examples provided. Analyze the input text and generate a suitable JSON structure."
+        )
+    else:
+        prompt_parts.append(_render_examples_block(examples))
+
+    prompt_parts.append("\n--- New Input Text ---")
+    prompt_parts.append(f"```\n{truncate_text(input_text, MAX_INPUT_CHARS)}\n```")
+    prompt_parts.append("\n--- Generated JSON Output ---")
+    # The model should place its JSON output after this line
+
+    full_prompt = "\n".join(prompt_parts)
+    logging.info(
+        f"Constructed prompt for Gemini (length: {len(full_prompt)} chars). Examples used: {len(examples)}"
+    )
+    # For debugging, you might want to log the full prompt, but be mindful of length and sensitive data
+    # logging.debug(f"Full Prompt:\n{full_prompt}")
+    return full_prompt
+
+
+# Generation and safety settings shared by every Gemini request.
+# Adjust these settings as needed
+_GEN_CFG = GenerationConfig(
+    temperature=0.5,  # Lower temperature for more deterministic JSON output
+    top_p=0.95,
+    top_k=40,
+    max_output_tokens=2048,  # Adjust based on expected JSON size
+    response_mime_type="application/json",  # Request JSON output directly if model supports it
+)
+
+# Configure safety settings (optional, adjust as needed)
+_SAFETY = {
+    HarmCategory.HARM_CATEGORY_HARASSMENT: SafetySetting.HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE,
+    HarmCategory.HARM_CATEGORY_HATE_SPEECH: SafetySetting.HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE,
+    HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: SafetySetting.HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE,
+    HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: SafetySetting.HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE,
+}
+
+# GenerativeModel instances by model name, created on first use and reused
+_MODEL_CACHE: dict[str, genai.GenerativeModel] = {}
+
+
+def _get_model(model_name: str) -> genai.GenerativeModel:
+    """Returns the shared Gemini model for model_name, creating it on first use."""
+    model = _MODEL_CACHE.get(model_name)
+    if model is None:
+        model = genai.GenerativeModel(
+            model_name=model_name,
+            generation_config=_GEN_CFG,
+            safety_settings=_SAFETY,
+        )
+        _MODEL_CACHE[model_name] = model
+    return model
+
+
+async def _stream_gemini_text(full_prompt: str, model_name: str) -> AsyncIterator[str]:
+    """Yields the raw text chunks of a streaming Gemini completion."""
+    model = _get_model(model_name)
+
+    logging.info(f"Sending streaming request to Gemini model: {model_name}")
+    response = await model.generate_content_async(full_prompt, stream=True)
+
+    async for chunk in response:
+        if not chunk.candidates:
+            feedback = getattr(chunk, "prompt_feedback", "No feedback available")
+            logging.warning(f"Gemini stream blocked. Feedback: {feedback}")
+            raise HTTPException(
+                status_code=500,
+                detail=f"Content generation blocked. Feedback: {feedback}",
+            )
+        # The final chunk may carry only a finish reason and no text
+        if chunk.parts:
+            yield chunk.text
+
+
+def _stream_error(message: str, raw_response: str) -> str:
+    """
+    Formats the trailer that ends a stream whose JSON turned out to be invalid:
+    a newline followed by a one-line JSON error object.
+    """
+    return "\n" + orjson.dumps(
+        {"error": message, "raw_response": raw_response}
+    ).decode()
+
 
-async def generate_json_with_gemini(
+async def stream_json_with_gemini(
     input_text: str, examples: list, model_name: str = "gemini-1.5-flash"
-) -> dict:
+) -> AsyncIterator[str]:
     """
-    Generates JSON using the Gemini API based on input text and examples.
+    Streams the JSON generated by the Gemini API as text chunks.
+
+    Markdown fences around the JSON are stripped, and the complete output is
+    parsed once the stream ends.
 
     Args:
         input_text: The new text input for which to generate JSON.
         examples: A list of TrainingPair objects to use as few-shot examples.
         model_name: The specific Gemini model to use.
 
-    Returns:
-        A dictionary containing the generated JSON or an error message.
+    Yields:
+        Chunks of the generated JSON text, in order. If generation fails or the
+        output is not valid JSON after some chunks were already yielded, the last
+        chunk is an error trailer (see _stream_error) instead of the rest of the output.
+
+    Raises:
+        HTTPException: If generation fails, or produces empty or invalid JSON,
+            before any chunk was yielded.
     """
     if not GEMINI_API_KEY:
         logging.error("Gemini API key is not configured. Cannot generate JSON.")
-        return {"error": "Gemini API key not configured on server."}
-
-    try:
-        # --- 1. Construct the Prompt ---
-        prompt_parts = [
-            "You are an assistant that analyzes text documents and generates structured JSON output based on the content.",
-            "Follow the format of the examples provided.",
-            "Given the following text input, generate the corresponding JSON object.",
-            "Output ONLY the JSON object itself, without any introductory text, explanation, or markdown formatting like ```json.",
-            "\n--- Examples ---",
-        ]
-
-        if not examples:
-            prompt_parts.append(
-                "\nNo examples provided. Analyze the input text and generate a suitable JSON structure."
-            )
-        else:
-            for i, example in enumerate(examples):
-                # Ensure example.json_data is loaded if stored as string
-                json_example_str = json.dumps(example.json_data, indent=2)
-                prompt_parts.append(f"\nExample {i+1}:")
-                prompt_parts.append("Input Text:")
-                prompt_parts.append(f"```\n{example.text_content}\n```")
-                prompt_parts.append("Output JSON:")
-                prompt_parts.append(f"```json\n{json_example_str}\n```")
-
-        prompt_parts.append("\n--- New Input Text ---")
-        prompt_parts.append(f"```\n{input_text}\n```")
-        prompt_parts.append("\n--- Generated JSON Output ---")
-        # The model should place its JSON output after this line
-
-        full_prompt = "\n".join(prompt_parts)
-        logging.info(
-            f"Constructed prompt for Gemini (length: {len(full_prompt)} chars). Examples used: {len(examples)}"
-        )
-        # For debugging, you might want to log the full prompt, but be mindful of length and sensitive data
-        # logging.debug(f"Full Prompt:\n{full_prompt}")
-
-        # --- 2. Configure Generation ---
-        # Adjust these settings as needed
-        generation_config = GenerationConfig(
-            temperature=0.5,  # Lower temperature for more deterministic JSON output
-            top_p=0.95,
-            top_k=40,
-            max_output_tokens=2048,  # Adjust based on expected JSON size
-            response_mime_type="application/json",  # Request JSON output directly if model supports it
+        raise HTTPException(
+            status_code=500, detail="Gemini API key not configured on server."
         )
 
-        # Configure safety settings (optional, adjust as needed)
-        safety_settings = {
-            HarmCategory.HARM_CATEGORY_HARASSMENT: SafetySetting.HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE,
-            HarmCategory.HARM_CATEGORY_HATE_SPEECH: SafetySetting.HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE,
-            HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: SafetySetting.HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE,
-            HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: SafetySetting.HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE,
-        }
+    full_prompt = _build_prompt(input_text, examples)
+    sent = []  # Everything yielded so far, kept for the final validation
+    pending = ""  # Received but not yet yielded
+    in_body = False  # Whether a leading ```json fence has been dealt with
 
-        # --- 3. Call the Gemini API ---
-        model = genai.GenerativeModel(
-            model_name=model_name,
-            generation_config=generation_config,
-            safety_settings=safety_settings,
+    try:
+        async for text in _stream_gemini_text(full_prompt, model_name):
+            pending += text
+            if not in_body:
+                stripped = pending.lstrip()
+                # Wait until it is clear whether the output opens with a fence
+                if "```json".startswith(stripped):
+                    continue
+                if stripped.startswith("```json"):
+                    stripped = stripped[7:].lstrip()
+                    if not stripped:
+                        continue
+                pending = stripped
+                in_body = True
+                # The prompt asks for a JSON object; anything else can be rejected
+                # before a single byte is sent
+                if pending[0] not in "{[":
+                    logging.error(f"Gemini response is not a JSON object: {pending!r}")
+                    raise HTTPException(
+                        status_code=500, detail="Failed to parse JSON from AI response."
+                    )
+            # Hold back the last three non-space characters in case they are the
+            # closing ``` fence
+            cut = len(pending.rstrip()) - 3
+            if cut > 0:
+                sent.append(pending[:cut])
+                yield pending[:cut]
+                pending = pending[cut:]
+    except Exception as e:
+        if isinstance(e, HTTPException):
+            message = e.detail
+        else:
+            logging.error(f"Error streaming from Gemini API: {e}")
+            message = f"An error occurred while communicating with the AI service: {str(e)}"
+        if not sent:
+            raise HTTPException(status_code=500, detail=message)
+        yield _stream_error(message, "".join(sent) + pending)
+        return
+
+    tail = pending.rstrip() if in_body else pending.strip()
+    if tail.endswith("```"):
+        tail = tail[:-3].rstrip()
+    generated_content = "".join(sent) + tail
+    logging.info("Finished streaming response from Gemini.")
+
+    if not generated_content.strip():
+        logging.error("Gemini returned an empty response.")
+        raise HTTPException(
+            status_code=500, detail="The AI service returned an empty response."
         )
 
-        logging.info(f"Sending request to Gemini model: {model_name}")
-        response = await model.generate_content_async(full_prompt)  # Use async version
-
-        # --- 4. Process the Response ---
-        logging.info("Received response from Gemini.")
-
-        # Check for safety blocks or empty response
-        if not response.candidates:
-            logging.warning(
-                "Gemini response blocked due to safety settings or other reasons."
-            )
-            # Access prompt feedback if available
-            feedback = (
-                response.prompt_feedback
-                if hasattr(response, "prompt_feedback")
-                else "No feedback available"
+    # --- Parse the Generated JSON ---
+    try:
+        orjson.loads(generated_content)
+        logging.info("Successfully parsed JSON from Gemini response.")
+    except orjson.JSONDecodeError as json_err:
+        logging.error(f"Failed to parse JSON from Gemini response: {json_err}")
+        logging.error(f"Raw Gemini response text:\n{generated_content}")
+        if not sent:
+            raise HTTPException(
+                status_code=500, detail="Failed to parse JSON from AI response."
             )
-            return {"error": f"Content generation blocked. Feedback: {feedback}"}
-
-        # Assuming the first candidate has the content
-        generated_content = response.text
-
-        # --- 5. Parse the Generated JSON ---
-        try:
-            # The model should ideally return only the JSON string due to the prompt
-            # and response_mime_type="application/json"
-            # Remove potential markdown fences if they still appear
-            if generated_content.strip().startswith("```json"):
-                generated_content = generated_content.strip()[7:]
-            if generated_content.strip().endswith("```"):
-                generated_content = generated_content.strip()[:-3]
-
-            generated_json = json.loads(generated_content.strip())
-            logging.info("Successfully parsed JSON from Gemini response.")
-            return generated_json
-        except json.JSONDecodeError as json_err:
-            logging.error(f"Failed to parse JSON from Gemini response: {json_err}")
-            logging.error(f"Raw Gemini response text:\n{generated_content}")
-            return {
-                "error": "Failed to parse JSON from AI response.",
-                "raw_response": generated_content,
-            }
-        except Exception as e:
-            # Catch other potential errors during response processing
-            logging.error(f"Error processing Gemini response: {e}")
-            return {
-                "error": f"An unexpected error occurred while processing the AI response: {str(e)}",
-                "raw_response": generated_content,
-            }
+        yield _stream_error("Failed to parse JSON from AI response.", generated_content)
+        return
 
-    except Exception as e:
-        # Catch errors during API call setup or execution
-        logging.error(f"Error calling Gemini API: {e}")
-        # You might want to check for specific API error types from the library
-        return {
-            "error": f"An error occurred while communicating with the AI service: {str(e)}"
-        }
+    if tail:
+        yield tail